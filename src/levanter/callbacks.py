@@ -1,32 +1,58 @@
 import copy
+import hashlib
+import itertools
 import logging as pylogging
 import os
-import re
-import subprocess
 import tempfile
 import threading
 import time
-import warnings
 from typing import Callable, Iterable, Optional
 
-import humanfriendly
 import jax
+import jax.numpy as jnp
 from tqdm import tqdm
 
+import haliax as hax
+
 import levanter.tracker
+from levanter.data.loader import BatchLoader
 from levanter.logging import save_xla_dumps_to_wandb
 from levanter.tracker.helpers import log_optimizer_hyperparams
 from levanter.tracker.wandb import WandbConfig
 from levanter.trainer import StepInfo
-from levanter.utils.jax_utils import jnp_to_python
+from levanter.utils.background_iterable import BackgroundIterable
+from levanter.utils.pprof_utils import read_device_memory_profile
 from levanter.visualization import compute_and_visualize_log_probs as viz_probs
 
 
 logger = pylogging.getLogger(__name__)
 
 
-def eval_loss_loop(loss_fn, model, dataset, max_batches: Optional[int] = None, name: Optional[str] = None):
-    total_loss = 0.0
+def eval_loss_loop(
+    loss_fn,
+    model,
+    dataset,
+    max_batches: Optional[int] = None,
+    name: Optional[str] = None,
+    prefetch_size: int = 2,
+    pbar_update_every: int = 10,
+    profile: bool = False,
+):
+    """
+    Computes the mean loss of `loss_fn` over `dataset`.
+
+    Batches are loaded in a background thread (up to `prefetch_size` ahead, unless `dataset` is a BatchLoader, which
+    already prefetches) so that data loading overlaps with device compute, and the loss is accumulated on device so
+    that we don't block on a device->host transfer every step. The progress bar's running mean loss is only refreshed
+    every `pbar_update_every` batches. We drop our reference to each batch as soon as its loss has been dispatched so that
+    its device buffers can be freed while the next batch is loading.
+
+    If `profile` is True, the average time spent waiting for batches and dispatching the loss is logged.
+    """
+    if pbar_update_every < 1:
+        raise ValueError(f"pbar_update_every must be at least 1, got {pbar_update_every}")
+
+    total_loss = jnp.zeros((), dtype=jnp.float32)
     total_load_time = 0.0
     total_loss_time = 0.0
     n = 0
@@ -36,33 +62,73 @@ def eval_loss_loop(loss_fn, model, dataset, max_batches: Optional[int] = None, n
     else:
         desc = "eval"
 
-    pbar = tqdm(dataset, desc=desc, position=1, leave=False, total=max_batches)
-    iter_ = iter(pbar)
-    while True:
-        time_in = time.time()
-        batch = next(iter_, None)
-        if batch is None:
-            break
-        load_time = time.time() - time_in
-        total_load_time += load_time
-        loss = loss_fn(model, batch)
-        total_loss += loss.item()
-        n += 1
-        loss_time = time.time() - time_in - load_time
-        total_loss_time += loss_time
+    def iterate_batches():
+        if max_batches is not None:
+            return itertools.islice(dataset, max_batches)
+        return iter(dataset)
 
-        pbar.set_postfix(loss=total_loss / n)
+    prefetched: Optional[BackgroundIterable] = None
+    if isinstance(dataset, BatchLoader):
+        # BatchLoaders already prefetch in their own background thread, so don't add another queue of device batches
+        iter_ = iterate_batches()
+    else:
+        # haliax's axis mapping is thread local, so we need to carry it over to the background thread
+        axis_mapping = hax.partitioning.current_thread_local_mapping()
 
-        if max_batches is not None and n >= max_batches:
-            break
+        def produce_batches():
+            with hax.axis_mapping(axis_mapping):
+                yield from iterate_batches()
 
-    if n > 0:
-        total_loss /= n
+        prefetched = BackgroundIterable(produce_batches, max_capacity=prefetch_size)
+        iter_ = iter(prefetched)
 
-    # logger.info(f"eval loading time: {total_load_time / n:.3f} s/ba")
-    # logger.info(f"eval loss time: {total_loss_time / n:.3f} s/ba")
+    if max_batches is not None:
+        total = max_batches
+    elif hasattr(dataset, "__len__"):
+        total = len(dataset)
+    else:
+        total = None
 
-    return total_loss
+    # we don't let tqdm wrap the iterable because it would hold on to the previous batch while fetching the next one
+    pbar = tqdm(desc=desc, position=1, leave=False, total=total)
+    try:
+        while True:
+            if profile:
+                time_in = time.perf_counter()
+            batch = next(iter_, None)
+            if batch is None:
+                break
+            if profile:
+                time_loaded = time.perf_counter()
+                total_load_time += time_loaded - time_in
+            loss = loss_fn(model, batch)
+            del batch
+            total_loss = total_loss + loss
+            n += 1
+            pbar.update(1)
+            if profile:
+                total_loss_time += time.perf_counter() - time_loaded
+
+            if n % pbar_update_every == 0:
+                pbar.set_postfix(loss=float(total_loss) / n)
+
+            if max_batches is not None and n >= max_batches:
+                break
+
+        if n % pbar_update_every != 0:
+            pbar.set_postfix(loss=float(total_loss) / n)
+    finally:
+        if prefetched is not None:
+            prefetched.stop()
+        pbar.close()
+
+    mean_loss = float(total_loss) / n if n > 0 else 0.0
+
+    if profile and n > 0:
+        logger.info(f"eval loading time: {total_load_time / n:.3f} s/ba")
+        logger.info(f"eval loss time: {total_loss_time / n:.3f} s/ba")
+
+    return mean_loss
 
 
 def compute_validation_loss(
@@ -122,38 +188,47 @@ def log_performance_stats(
             return f"{prefix}/{key}"
         return key
 
+    # these are the same every step, so only build them once
+    total_tokens_key = wrap_key("total_tokens")
+    total_gflops_key = wrap_key("total_gflops")
+    examples_per_second_key = wrap_key("examples_per_second")
+    tokens_per_second_key = wrap_key("tokens_per_second")
+    duration_key = wrap_key("duration")
+    gflops_per_second_key = wrap_key("gflops_per_second")
+
     def log_performance_stats(step_info: StepInfo):
+        metrics: dict[str, float] = {}
 
         # log these totals because it's useful for comparing different seqlens, batch sizes, etc
         total_tokens = tokens_per_example * batch_size * step_info.step
-        levanter.tracker.log_metrics({wrap_key("total_tokens"): total_tokens}, step=step_info.step)
+        metrics[total_tokens_key] = total_tokens
 
         if flops_per_example:
             total_flops = flops_per_example * batch_size * step_info.step
-            levanter.tracker.log_metrics({wrap_key("total_gflops"): total_flops / 1e9}, step=step_info.step)
+            metrics[total_gflops_key] = total_flops / 1e9
 
         if step_info.step_duration != 0.0:
-            levanter.tracker.log_metrics(
-                {
-                    wrap_key("examples_per_second"): float(batch_size) / step_info.step_duration,
-                    wrap_key("tokens_per_second"): float(tokens_per_example) / step_info.step_duration * batch_size,
-                    wrap_key("duration"): step_info.step_duration,
-                },
-                step=step_info.step,
-            )
+            inv_dur = 1.0 / step_info.step_duration
+            metrics[examples_per_second_key] = float(batch_size) * inv_dur
+            metrics[tokens_per_second_key] = float(tokens_per_example) * batch_size * inv_dur
+            metrics[duration_key] = step_info.step_duration
 
             if flops_per_example is not None:
-                levanter.tracker.log_metrics(
-                    {
-                        wrap_key("gflops_per_second"): flops_per_example / 1e9 / step_info.step_duration * batch_size,
-                    },
-                    step=step_info.step,
-                )
+                metrics[gflops_per_second_key] = flops_per_example / 1e9 * batch_size * inv_dur
+
+        levanter.tracker.log_metrics(metrics, step=step_info.step)
 
     return log_performance_stats
 
 
-def pbar_logger(iterable=None, desc="train", **tqdm_mkwargs):
+def pbar_logger(iterable=None, desc="train", postfix_every: int = 10, **tqdm_mkwargs):
+    """
+    Returns a hook that advances a progress bar every step. The loss shown in the postfix is only refreshed every
+    `postfix_every` steps (and on the last step), to cut down on progress bar redraws.
+    """
+    if postfix_every < 1:
+        raise ValueError(f"postfix_every must be at least 1, got {postfix_every}")
+
     kwargs = copy.copy(tqdm_mkwargs)
     if "desc" not in kwargs:
         kwargs["desc"] = desc
@@ -163,19 +238,20 @@ def pbar_logger(iterable=None, desc="train", **tqdm_mkwargs):
 
     def update_pbar(step: StepInfo):
         pbar.update(step.next_step - pbar.n)
-        pbar.set_postfix(loss=jnp_to_python(step.loss))
+        if step.step % postfix_every == 0 or step.next_step == pbar.total:
+            pbar.set_postfix(loss=step.loss)
 
     return update_pbar
 
 
 def log_memory_usage(sample_interval: float = 1.0, log_individual_devices: bool = False):
     """
-    Logs memory usage. This runs a loop that samples memory usage every `sample_interval` seconds.
-    We only log when hooks are invoked, so there's not much point in running this much more frequently than you invoke
-    the hook.
+    Logs memory usage. Each time the hook is invoked, it asks a background thread to write a fresh device memory
+    profile and waits up to `sample_interval` seconds for it, so the logged values reflect memory at the current step.
+    Nothing is written while the hook isn't being invoked. If the profile isn't written in time, the most recent one
+    (if any) is logged instead.
 
-    I think it's a good idea to run this in a separate thread, so that you sample from random points, but I'm not sure.
-    :param sample_interval:
+    :param sample_interval: maximum number of seconds the hook waits for a fresh profile
     :return:
     """
 
@@ -188,73 +264,82 @@ def log_memory_usage(sample_interval: float = 1.0, log_individual_devices: bool
 
     # a lot of this code is lifted from https://github.com/ayaka14732/jax-smi CC-0
 
+    # Each hook call requests a new generation of the profile. The sampler thread records the last generation it
+    # finished (successfully or not) and the last one whose profile was actually published, so a hook call can tell
+    # whether the file on disk was sampled for it or is left over from an earlier request.
+    sample_cond = threading.Condition()
+    requested_generation = 0
+    finished_generation = 0
+    published_generation = 0
+
     def inner():
-        import posix
-        import time
+        nonlocal finished_generation, published_generation
+        new_tempfile_name = f"{tempfile_name}.new"
+        last_digest = None
 
         while True:
-            jax.profiler.save_device_memory_profile(f"{tempfile_name}.new")
-            posix.rename(f"{tempfile_name}.new", tempfile_name)
-            time.sleep(sample_interval)
+            with sample_cond:
+                sample_cond.wait_for(lambda: requested_generation > finished_generation)
+                # requests that arrive while we're writing are coalesced into the next write
+                generation = requested_generation
+
+            published = False
+            try:
+                jax.profiler.save_device_memory_profile(new_tempfile_name)
+
+                # memory usage is usually stable between samples, so don't republish an identical profile
+                with open(new_tempfile_name, "rb") as f:
+                    digest = hashlib.blake2b(f.read()).digest()
+
+                if digest != last_digest:
+                    os.replace(new_tempfile_name, tempfile_name)
+                    last_digest = digest
+                else:
+                    os.unlink(new_tempfile_name)
+                published = True
+            except Exception:
+                logger.exception("Failed to write memory profile")
+            finally:
+                # always wake up the hook, even if we failed, so that it doesn't wait for a write that won't come
+                with sample_cond:
+                    finished_generation = generation
+                    if published:
+                        published_generation = generation
+                    sample_cond.notify_all()
 
     thread = threading.Thread(target=inner, daemon=True)
     thread.start()
 
     def log_memory_usage(step: StepInfo):
-        process = subprocess.run(
-            args=f"go tool pprof -tags {tempfile_name}".split(" "),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL,
-        )
-
-        if process.returncode != 0:
-            warnings.warn("failed to run pprof. Is go installed?")
+        nonlocal requested_generation
+        with sample_cond:
+            requested_generation += 1
+            generation = requested_generation
+            sample_cond.notify_all()
+            # if the sampler thread has died, there's no point waiting on it
+            if thread.is_alive():
+                sample_cond.wait_for(lambda: finished_generation >= generation, timeout=sample_interval)
+            fresh = published_generation >= generation
+
+        try:
+            profile = read_device_memory_profile(tempfile_name, by_device=log_individual_devices)
+        except FileNotFoundError:
+            logger.warning(f"No memory profile has been written yet, so not logging memory usage at step {step.step}.")
             return
 
-        output = process.stdout.decode("utf-8")
-
-        # output looks like this:
-        #          2.4MB (12.53%): TFRT_CPU_0
-        #          2.4MB (12.50%): TFRT_CPU_1
-        #          2.4MB (12.50%): TFRT_CPU_2
-        #          2.4MB (12.50%): TFRT_CPU_3
-        #          2.4MB (12.50%): TFRT_CPU_4
-        #          2.4MB (12.50%): TFRT_CPU_5
-        #          2.4MB (12.50%): TFRT_CPU_6
-        #          2.4MB (12.50%): TFRT_CPU_7
-        #
-        #  kind: Total 19.5MB
-        #         18.9MB (97.20%): buffer
-        #        558.4kB ( 2.80%): executable
-
-        # gpus look like this:
-        #          1.0MB ( 0.00%): gpu:0
-        per_device, by_kind = output.split("kind: Total ")
-
-        # first, get the total memory usage
-        regex = re.compile(r"^(\d+\.\d+[a-zA-Z]+)")
-        match = regex.search(by_kind)
-        if match:
-            memory_usage = humanfriendly.parse_size(match.group(1))
-            levanter.tracker.log_metrics({"memory/total": memory_usage / 1e6}, step=step.step)
-
-        # this works for the "kind" and the individual devices
-        regex = re.compile(r"([\d.]+[a-zA-Z]+) \(([\d.]+)%\): ([\w\d:_]+)")
+        if not fresh:
+            logger.warning(f"Couldn't get a fresh memory profile at step {step.step}. Logging the previous one.")
+
+        metrics: dict[str, float] = {"memory/total": profile.total / 1e6}
 
         if log_individual_devices:
-            # now, get the memory usage per device.
-            # split the output at kind: Total
-            for match in regex.finditer(per_device):
-                memory_usage = humanfriendly.parse_size(match.group(1))
-                device_name = match.group(3)
-                levanter.tracker.log_metrics({f"memory/device/{device_name}": memory_usage / 1e6}, step=step.step)
-
-        # now, get the memory usage per kind.
-        # same regex as above
-        for match in regex.finditer(by_kind):
-            memory_usage = match.group(1)
-            memory_usage = humanfriendly.parse_size(memory_usage)
-            levanter.tracker.log_metrics({f"memory/{match.group(3)}": memory_usage / 1e6}, step=step.step)
+            for device_name, memory_usage in profile.by_device.items():
+                metrics[f"memory/device/{device_name}"] = memory_usage / 1e6
+
+        for kind, memory_usage in profile.by_kind.items():
+            metrics[f"memory/{kind}"] = memory_usage / 1e6
+
+        levanter.tracker.log_metrics(metrics, step=step.step)
 
     return log_memory_usage
 
@@ -39,6 +39,8 @@ class BackgroundIterable(Iterable[Ex]):
             elif isinstance(batch, _ExceptionWrapper):
                 batch.reraise()
             yield batch
+            # don't keep the batch alive while we wait on the queue for the next one
+            del batch
 
     def __del__(self):
         self.stop()
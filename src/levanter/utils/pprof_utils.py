@@ -0,0 +1,142 @@
+"""
+Minimal in-process reader for the pprof profiles written by `jax.profiler.save_device_memory_profile`.
+
+This lets us summarize device memory usage without shelling out to `go tool pprof`. We only decode the handful of
+fields of https://github.com/google/pprof/blob/main/proto/profile.proto that we need (samples, their labels, and
+the string table), so there's no dependency on generated protobuf bindings.
+"""
+import dataclasses
+import gzip
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List, Tuple
+
+
+@dataclasses.dataclass
+class DeviceMemoryProfile:
+    """Memory usage in bytes, aggregated the same way `go tool pprof -tags` does."""
+
+    total: int
+    by_device: Dict[str, int]
+    by_kind: Dict[str, int]
+
+
+def read_device_memory_profile(path: str, by_device: bool = True) -> DeviceMemoryProfile:
+    with open(path, "rb") as f:
+        return parse_device_memory_profile(f.read(), by_device=by_device)
+
+
+def parse_device_memory_profile(data: bytes, by_device: bool = True) -> DeviceMemoryProfile:
+    """
+    Parses a (possibly gzipped) pprof profile and sums the default sample value (the last sample type, which is
+    "space" in bytes for JAX's memory profiles) by the "device" and "kind" labels.
+
+    If `by_device` is False, the per-device breakdown is skipped and left empty.
+    """
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+
+    # We make a single pass over the profile, summing amounts by (label key, label value) string table indices, and
+    # only decode the strings we need at the end. Working on a memoryview means the nested messages aren't copied.
+    string_table: List[memoryview] = []
+    total = 0
+    by_label: Dict[Tuple[int, int], int] = defaultdict(int)
+
+    for field, wire_type, value in _iter_fields(memoryview(data)):
+        if field == 2 and wire_type == _LEN:  # Profile.sample
+            values, labels = _parse_sample(value)
+            if not values:
+                continue
+            amount = values[-1]
+            total += amount
+            for label in labels:
+                by_label[label] += amount
+        elif field == 6 and wire_type == _LEN:  # Profile.string_table
+            string_table.append(value)
+
+    per_device: Dict[str, int] = {}
+    per_kind: Dict[str, int] = {}
+
+    for (key, str_index), amount in by_label.items():
+        label_name = str(string_table[key], "utf-8")
+        if label_name == "kind":
+            per_kind[str(string_table[str_index], "utf-8")] = amount
+        elif by_device and label_name == "device":
+            per_device[str(string_table[str_index], "utf-8")] = amount
+
+    return DeviceMemoryProfile(total=total, by_device=per_device, by_kind=per_kind)
+
+
+_VARINT = 0
+_I64 = 1
+_LEN = 2
+_I32 = 5
+
+
+def _parse_sample(data: memoryview) -> Tuple[List[int], List[Tuple[int, int]]]:
+    values: List[int] = []
+    labels: List[Tuple[int, int]] = []
+    for field, wire_type, value in _iter_fields(data):
+        if field == 2:  # Sample.value, repeated int64 (usually packed)
+            if wire_type == _LEN:
+                values.extend(_to_int64(v) for v in _iter_packed_varints(value))
+            else:
+                values.append(_to_int64(value))
+        elif field == 3 and wire_type == _LEN:  # Sample.label
+            key = 0
+            str_index = 0
+            for label_field, _, label_value in _iter_fields(value):
+                if label_field == 1:
+                    key = label_value
+                elif label_field == 2:
+                    str_index = label_value
+            labels.append((key, str_index))
+    return values, labels
+
+
+def _iter_fields(data: memoryview) -> Iterator[Tuple[int, int, Any]]:
+    """Yields (field number, wire type, value), where value is an int or, for length-delimited fields, a memoryview."""
+    pos = 0
+    end = len(data)
+    while pos < end:
+        tag, pos = _read_varint(data, pos)
+        field, wire_type = tag >> 3, tag & 0x7
+        if wire_type == _VARINT:
+            value, pos = _read_varint(data, pos)
+            yield field, wire_type, value
+        elif wire_type == _LEN:
+            length, pos = _read_varint(data, pos)
+            yield field, wire_type, data[pos : pos + length]
+            pos += length
+        elif wire_type == _I64:
+            yield field, wire_type, int.from_bytes(data[pos : pos + 8], "little")
+            pos += 8
+        elif wire_type == _I32:
+            yield field, wire_type, int.from_bytes(data[pos : pos + 4], "little")
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+
+
+def _iter_packed_varints(data: memoryview) -> Iterator[int]:
+    pos = 0
+    while pos < len(data):
+        value, pos = _read_varint(data, pos)
+        yield value
+
+
+def _read_varint(data: memoryview, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _to_int64(value: int) -> int:
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
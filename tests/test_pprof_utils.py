@@ -0,0 +1,33 @@
+import os
+import tempfile
+
+import jax
+import jax.numpy as jnp
+
+from levanter.utils.pprof_utils import parse_device_memory_profile
+
+
+def test_parse_device_memory_profile():
+    x = jnp.ones((1024, 256), dtype=jnp.float32)
+    x.block_until_ready()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "memory.prof")
+        jax.profiler.save_device_memory_profile(path)
+        with open(path, "rb") as f:
+            data = f.read()
+
+    profile = parse_device_memory_profile(data)
+
+    assert profile.total >= x.nbytes
+    assert profile.by_kind["buffer"] >= x.nbytes
+    assert sum(profile.by_kind.values()) == profile.total
+    assert sum(profile.by_device.values()) == profile.total
+    assert len(profile.by_device) == len(jax.devices())
+
+    # skipping the per-device breakdown shouldn't change anything else
+    without_devices = parse_device_memory_profile(data, by_device=False)
+
+    assert without_devices.by_device == {}
+    assert without_devices.by_kind == profile.by_kind
+    assert without_devices.total == profile.total